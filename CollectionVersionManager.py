@@ -0,0 +1,726 @@
+import json
+import os
+import socket
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Tuple
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents.base import Document
+from langchain_core.pydantic_v1 import Field
+from langchain_core.retrievers import BaseRetriever
+from langchain_openai import OpenAIEmbeddings
+from langchain_postgres import PGVector
+
+from helpers import clean_chunk, get_db_connection, get_existing_sources, get_vector_store
+from helpers import load_documents_from_pdfs, source_name, split_documents, update_vector_store
+
+
+REGISTRY_TABLE_NAME = "collection_versions"
+
+# Defaults the legacy, unversioned collection was built with
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_CHUNK_OVERLAP = 100
+DEFAULT_EMBEDDING_MODEL = "text-embedding-3-small"
+
+
+class CollectionVersionManager:
+    """
+    Keep track of versioned PGVector collections and of the one currently serving queries.
+
+    Every version is a separate collection named ``<base_name>_v<timestamp>`` and is
+    recorded in the ``collection_versions`` table together with the parameters it was
+    built with. A version goes through ``building`` -> ``ready`` -> ``active`` -> ``retired``
+    (or ``failed``). Retired versions are kept around for rollback until they are
+    garbage-collected.
+    """
+
+    @classmethod
+    def create_registry_table(cls, connection, table_name: str = REGISTRY_TABLE_NAME):
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table_name} (
+                    name TEXT PRIMARY KEY,
+                    chunk_size INTEGER NOT NULL,
+                    chunk_overlap INTEGER NOT NULL,
+                    embedding_model TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                    retired_at TIMESTAMP WITH TIME ZONE
+                );
+            """)
+            # Builds record who runs them and when they last made progress
+            cursor.execute(f"""
+                ALTER TABLE {table_name}
+                    ADD COLUMN IF NOT EXISTS owner TEXT,
+                    ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP WITH TIME ZONE;
+            """)
+            # At most one active version and one build at any time
+            cursor.execute(f"""
+                CREATE UNIQUE INDEX IF NOT EXISTS {table_name}_single_active
+                ON {table_name} ((status)) WHERE status = 'active';
+            """)
+            cursor.execute(f"""
+                CREATE UNIQUE INDEX IF NOT EXISTS {table_name}_single_building
+                ON {table_name} ((status)) WHERE status = 'building';
+            """)
+            connection.commit()
+
+    def __init__(self,
+                 base_name: str,
+                 connection: str,
+                 s3_client,
+                 bucket_name: str,
+                 api_key: str = None,
+                 rollback_versions: int = 1,
+                 retention: timedelta = timedelta(days=7),
+                 build_timeout: timedelta = timedelta(minutes=15)):
+        """
+        :param base_name: The name of the legacy collection, used as a prefix for new versions.
+        :param connection: The SQLAlchemy connection string used by PGVector.
+        :param s3_client: The boto3 S3 client holding the source PDFs.
+        :param bucket_name: The S3 bucket holding the source PDFs.
+        :param api_key: The OpenAI API key.
+        :param rollback_versions: Number of most recently retired versions never garbage-collected.
+        :param retention: How long other retired versions are kept before being garbage-collected.
+        :param build_timeout: How long a build may go without a heartbeat before it is considered abandoned.
+        """
+        self.base_name = base_name
+        self.connection = connection
+        self.s3 = s3_client
+        self.bucket_name = bucket_name
+        self.api_key = api_key
+        self.rollback_versions = rollback_versions
+        self.retention = retention
+        self.build_timeout = build_timeout
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+        # Held while writing into the active collection and while switching versions,
+        # so that no upload of this process lands in a collection that is being retired.
+        # Other processes are kept out by locking the registry, see add_document.
+        self.ingest_lock = threading.RLock()
+        self._scheduler_stop = threading.Event()
+        self._scheduler_thread = None
+
+        db_connection = get_db_connection()
+        try:
+            self.create_registry_table(db_connection)
+            self._register_legacy_collection(db_connection)
+            # Builds interrupted by a restart never finish, so free the slot for new ones
+            self._fail_stale_builds(db_connection)
+            version, chunk_size, chunk_overlap, embedding_model = self._get_active_version(db_connection)
+        finally:
+            db_connection.close()
+
+        # (version, embedding model, chunking, vector store) swapped as a single reference
+        self._active = self._load_version(version, embedding_model, (chunk_size, chunk_overlap))
+
+    @property
+    def active_version(self) -> str:
+        return self._active[0]
+
+    @property
+    def active_embedding_model(self) -> str:
+        return self._active[1]
+
+    @property
+    def active_chunking(self) -> Tuple[int, int]:
+        return self._active[2]
+
+    @property
+    def vector_store(self) -> PGVector:
+        return self._active[3]
+
+    def _register_legacy_collection(self, db_connection) -> None:
+        """
+        Record the pre-existing, unversioned collection as the active version
+        if the registry is still empty.
+        """
+        with db_connection.cursor() as cursor:
+            cursor.execute(f"""
+                INSERT INTO {REGISTRY_TABLE_NAME} (name, chunk_size, chunk_overlap, embedding_model, status)
+                SELECT %s, %s, %s, %s, 'active'
+                WHERE NOT EXISTS (SELECT 1 FROM {REGISTRY_TABLE_NAME})
+                ON CONFLICT DO NOTHING
+            """, (self.base_name, DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP, DEFAULT_EMBEDDING_MODEL))
+        db_connection.commit()
+
+    def _get_active_version(self, db_connection) -> Tuple[str, int, int, str]:
+        with db_connection.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT name, chunk_size, chunk_overlap, embedding_model FROM {REGISTRY_TABLE_NAME}
+                WHERE status = 'active'
+            """)
+            row = cursor.fetchone()
+        if row is None:
+            raise ValueError(f"No active collection version found in {REGISTRY_TABLE_NAME}.")
+        return row[0], row[1], row[2], row[3]
+
+    def _fail_stale_builds(self, db_connection) -> None:
+        """
+        Mark builds without a recent heartbeat as failed, so they get garbage-collected.
+        """
+        with db_connection.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {REGISTRY_TABLE_NAME} SET status = 'failed'
+                WHERE status = 'building'
+                AND COALESCE(heartbeat_at, created_at) < CURRENT_TIMESTAMP - %s
+            """, (self.build_timeout,))
+            stale = cursor.rowcount
+        db_connection.commit()
+        if stale:
+            print(f"Marked {stale} abandoned collection builds as failed.")
+
+    def _heartbeat(self, version: str, stop: threading.Event) -> None:
+        """
+        Periodically record that a build is still making progress, until stopped.
+        """
+        interval = self.build_timeout.total_seconds() / 3
+        while not stop.wait(interval):
+            try:
+                db_connection = get_db_connection()
+                try:
+                    with db_connection.cursor() as cursor:
+                        cursor.execute(f"""
+                            UPDATE {REGISTRY_TABLE_NAME} SET heartbeat_at = CURRENT_TIMESTAMP
+                            WHERE name = %s AND status = 'building'
+                        """, (version,))
+                    db_connection.commit()
+                finally:
+                    db_connection.close()
+            except Exception as e:
+                print(f"Error recording heartbeat for collection version {version}: {e}")
+
+    def _get_embeddings_model(self, embedding_model: str) -> OpenAIEmbeddings:
+        return OpenAIEmbeddings(api_key=self.api_key, model=embedding_model)
+
+    def _load_version(self,
+                      version: str,
+                      embedding_model: str,
+                      chunking: Tuple[int, int] = None) -> Tuple[str, str, Tuple[int, int], PGVector]:
+        vector_store = get_vector_store(self._get_embeddings_model(embedding_model),
+                                        version,
+                                        self.connection)
+        return version, embedding_model, chunking, vector_store
+
+    def _set_status(self, version: str, status: str, current_status: str = 'building') -> bool:
+        """
+        Move a version from one status to another.
+
+        :return: Whether the version was in current_status and got updated.
+        """
+        db_connection = get_db_connection()
+        try:
+            with db_connection.cursor() as cursor:
+                cursor.execute(f"""
+                    UPDATE {REGISTRY_TABLE_NAME} SET status = %s
+                    WHERE name = %s AND status = %s
+                """, (status, version, current_status))
+                updated = cursor.rowcount == 1
+            db_connection.commit()
+        finally:
+            db_connection.close()
+        return updated
+
+    def list_versions(self) -> List[Dict[str, Any]]:
+        """
+        Retrieve all registered collection versions, newest first.
+
+        :return: A list of dictionaries describing each version.
+        """
+        db_connection = get_db_connection()
+        try:
+            with db_connection.cursor() as cursor:
+                cursor.execute(f"""
+                    SELECT name, chunk_size, chunk_overlap, embedding_model, status, created_at, retired_at
+                    FROM {REGISTRY_TABLE_NAME}
+                    ORDER BY created_at DESC
+                """)
+                rows = cursor.fetchall()
+        finally:
+            db_connection.close()
+
+        return [{"name": row[0],
+                 "chunk_size": row[1],
+                 "chunk_overlap": row[2],
+                 "embedding_model": row[3],
+                 "status": row[4],
+                 "created_at": row[5],
+                 "retired_at": row[6]} for row in rows]
+
+    def create_version(self,
+                       chunk_size: int = DEFAULT_CHUNK_SIZE,
+                       chunk_overlap: int = DEFAULT_CHUNK_OVERLAP,
+                       embedding_model: str = DEFAULT_EMBEDDING_MODEL) -> str:
+        """
+        Register a new collection version in the ``building`` state.
+
+        :param chunk_size: Chunk size passed to split_documents.
+        :param chunk_overlap: Chunk overlap passed to split_documents.
+        :param embedding_model: The OpenAI embedding model for the new version.
+        :return: The name of the new version.
+        :raises ValueError: If another version is still being built.
+        """
+        version = f"{self.base_name}_v{datetime.now(timezone.utc):%Y%m%d%H%M%S%f}"
+
+        db_connection = get_db_connection()
+        try:
+            self._fail_stale_builds(db_connection)
+            with db_connection.cursor() as cursor:
+                # Only one build at a time, enforced by the single_building index
+                cursor.execute(f"""
+                    INSERT INTO {REGISTRY_TABLE_NAME}
+                        (name, chunk_size, chunk_overlap, embedding_model, status, owner, heartbeat_at)
+                    VALUES (%s, %s, %s, %s, 'building', %s, CURRENT_TIMESTAMP)
+                    ON CONFLICT ((status)) WHERE status = 'building' DO NOTHING
+                """, (version, chunk_size, chunk_overlap, embedding_model, self.owner))
+                created = cursor.rowcount == 1
+            db_connection.commit()
+        finally:
+            db_connection.close()
+
+        if not created:
+            raise ValueError("Another collection version is already being built.")
+
+        return version
+
+    def build_version(self, version: str, activate: bool = True) -> None:
+        """
+        Ingest every PDF in the S3 bucket into a registered version, validate it
+        and optionally switch queries over to it.
+
+        Documents uploaded while the build is running are picked up before the
+        switch. Uploads, in any process, are only blocked while the final S3
+        listing is checked and the version is switched.
+
+        :param version: The name of a version in the ``building`` state.
+        :param activate: Whether to make the version active once it is validated.
+        """
+        db_connection = get_db_connection()
+        try:
+            with db_connection.cursor() as cursor:
+                cursor.execute(f"""
+                    SELECT chunk_size, chunk_overlap, embedding_model FROM {REGISTRY_TABLE_NAME}
+                    WHERE name = %s AND status = 'building'
+                """, (version,))
+                row = cursor.fetchone()
+        finally:
+            db_connection.close()
+
+        if row is None:
+            raise ValueError(f"Collection version {version} is not being built.")
+        chunk_size, chunk_overlap, embedding_model = row
+
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat,
+                                     args=(version, stop_heartbeat),
+                                     name=f"heartbeat-{version}",
+                                     daemon=True)
+        heartbeat.start()
+
+        try:
+            print(f"Building collection version {version}...")
+            vector_store = self._load_version(version, embedding_model)[3]
+
+            keys = []
+            chunk_count = 0
+            while True:
+                # Catch up on documents uploaded while the build was running
+                missing_keys = [key for key in self._list_pdf_keys() if key not in keys]
+                chunk_count += self._ingest(vector_store, missing_keys, chunk_size, chunk_overlap, embedding_model)
+                keys.extend(missing_keys)
+
+                self._validate(vector_store, version, chunk_count, keys, require_active_sources=activate)
+
+                with self.ingest_lock:
+                    db_connection = get_db_connection()
+                    try:
+                        with db_connection.cursor() as cursor:
+                            # Uploads in every process are blocked from here on,
+                            # so only switch if nothing new arrived
+                            cursor.execute(f"LOCK TABLE {REGISTRY_TABLE_NAME} IN EXCLUSIVE MODE")
+                            if any(key not in keys for key in self._list_pdf_keys()):
+                                db_connection.rollback()
+                                continue
+
+                            cursor.execute(f"""
+                                UPDATE {REGISTRY_TABLE_NAME} SET status = 'ready'
+                                WHERE name = %s AND status = 'building'
+                            """, (version,))
+                            if cursor.rowcount != 1:
+                                raise ValueError(f"Collection version {version} is no longer being built.")
+
+                        if activate:
+                            self._switch(db_connection, version)
+                        db_connection.commit()
+                    finally:
+                        db_connection.close()
+
+                    print(f"Collection version {version} built with {chunk_count} chunks.")
+                    if activate:
+                        self._active = self._load_version(version, embedding_model, (chunk_size, chunk_overlap))
+                        print(f"Switched active collection version to {version}.")
+                break
+        except Exception as e:
+            print(f"Error building collection version {version}: {e}")
+            self._set_status(version, "failed")
+            raise
+        finally:
+            stop_heartbeat.set()
+
+    def _list_pdf_keys(self) -> List[str]:
+        keys = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []) if obj['Key'].endswith('.pdf'))
+        return keys
+
+    def _ingest(self,
+                vector_store: PGVector,
+                keys: List[str],
+                chunk_size: int,
+                chunk_overlap: int,
+                embedding_model: str) -> int:
+        """
+        Download, split and embed the given PDFs into a vector store, one document at a time.
+
+        :return: The number of chunks added.
+        """
+        embeddings_model = self._get_embeddings_model(embedding_model)
+        chunk_count = 0
+
+        for key in keys:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                local_file_path = os.path.join(tmp_dir, source_name(key))
+                self.s3.download_file(self.bucket_name, key, local_file_path)
+                documents = load_documents_from_pdfs([local_file_path])
+                chunks = split_documents(documents, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+            if not chunks:
+                continue
+
+            texts = [clean_chunk(chunk['text']) for chunk in chunks]
+            # Record the S3 key rather than the temporary path as the source
+            metadata = [{**chunk['metadata'], 'source': key} for chunk in chunks]
+
+            cached = self._get_cached_embeddings(texts, embedding_model)
+            missing_texts = list({text for text in texts if text not in cached})
+            if missing_texts:
+                cached.update(zip(missing_texts, embeddings_model.embed_documents(missing_texts)))
+            print(f"Embedded {len(missing_texts)} new chunks for {key}, "
+                  f"reused {len(texts) - len(missing_texts)} cached embeddings.")
+
+            vector_store.add_embeddings(texts=texts,
+                                        embeddings=[cached[text] for text in texts],
+                                        metadatas=metadata)
+            chunk_count += len(texts)
+
+        return chunk_count
+
+    def _get_cached_embeddings(self, texts: List[str], embedding_model: str) -> Dict[str, List[float]]:
+        """
+        Look up embeddings of identical chunks in any existing version built with the same model.
+
+        :return: A mapping from chunk text to its embedding.
+        """
+        db_connection = get_db_connection()
+        try:
+            with db_connection.cursor() as cursor:
+                cursor.execute(f"""
+                    SELECT DISTINCT ON (e.document) e.document, e.embedding::text
+                    FROM langchain_pg_embedding e
+                    INNER JOIN langchain_pg_collection lc ON e.collection_id = lc.uuid
+                    INNER JOIN {REGISTRY_TABLE_NAME} cv ON cv.name = lc.name
+                    WHERE cv.embedding_model = %s AND e.document = ANY(%s)
+                """, (embedding_model, texts))
+                rows = cursor.fetchall()
+        finally:
+            db_connection.close()
+
+        # pgvector's text representation is a JSON array
+        return {row[0]: json.loads(row[1]) for row in rows}
+
+    def _validate(self,
+                  vector_store: PGVector,
+                  version: str,
+                  expected_chunks: int,
+                  keys: List[str],
+                  require_active_sources: bool = True) -> None:
+        """
+        Check that a freshly built version is complete and can serve queries.
+
+        :param vector_store: The vector store of the new version.
+        :param version: The name of the new version.
+        :param expected_chunks: The number of chunks the build inserted.
+        :param keys: The S3 keys the build ingested.
+        :param require_active_sources: Whether every document of the active version must be present.
+        :raises ValueError: If the version fails validation.
+        """
+        if expected_chunks == 0:
+            raise ValueError(f"Collection version {version} is empty.")
+
+        db_connection = get_db_connection()
+        try:
+            with db_connection.cursor() as cursor:
+                cursor.execute("""
+                    SELECT COUNT(*), MIN(e.document)
+                    FROM langchain_pg_embedding e
+                    INNER JOIN langchain_pg_collection lc ON e.collection_id = lc.uuid
+                    WHERE lc.name = %s
+                """, (version,))
+                stored_chunks, probe = cursor.fetchone()
+
+            # Legacy sources are Windows paths, newer ones S3 keys, so compare file names
+            sources = {source_name(source) for source in get_existing_sources(db_connection, version)}
+            active_sources = {source_name(source)
+                              for source in get_existing_sources(db_connection, self.active_version)}
+        finally:
+            db_connection.close()
+
+        if stored_chunks != expected_chunks:
+            raise ValueError(f"Collection version {version} holds {stored_chunks} chunks, "
+                             f"expected {expected_chunks}.")
+
+        # PDFs that failed to load or produced no text leave no chunks behind
+        failed_sources = {source_name(key) for key in keys} - sources
+        if failed_sources:
+            raise ValueError(f"Collection version {version} is missing documents from S3: "
+                             f"{sorted(failed_sources)}")
+
+        # Documents that only exist in the active version, e.g. ingested from local files
+        dropped_sources = active_sources - sources
+        if dropped_sources:
+            if require_active_sources:
+                raise ValueError(f"Collection version {version} is missing documents of the active version "
+                                 f"{self.active_version}: {sorted(dropped_sources)}")
+            print(f"Collection version {version} is missing documents of the active version "
+                  f"{self.active_version}: {sorted(dropped_sources)}")
+
+        if not vector_store.similarity_search(probe, k=1):
+            raise ValueError(f"Collection version {version} returned no results for a probe query.")
+
+    def _switch(self, db_connection, version: str) -> Tuple[int, int, str]:
+        """
+        Make a version the active one within the caller's transaction and retire the
+        previously active one. The registry stays locked until the caller commits.
+
+        :return: The chunk size, chunk overlap and embedding model of the version.
+        :raises ValueError: If the version cannot be activated.
+        """
+        with db_connection.cursor() as cursor:
+            # Serializes activations and waits for uploads holding the active row,
+            # the single_active index backs this up
+            cursor.execute(f"LOCK TABLE {REGISTRY_TABLE_NAME} IN EXCLUSIVE MODE")
+            cursor.execute(f"""
+                SELECT chunk_size, chunk_overlap, embedding_model FROM {REGISTRY_TABLE_NAME}
+                WHERE name = %s AND status IN ('ready', 'retired', 'active')
+            """, (version,))
+            row = cursor.fetchone()
+            if row is None:
+                raise ValueError(f"Collection version {version} does not exist or is not ready.")
+
+            cursor.execute(f"""
+                UPDATE {REGISTRY_TABLE_NAME}
+                SET status = 'retired', retired_at = CURRENT_TIMESTAMP
+                WHERE status = 'active' AND name <> %s
+            """, (version,))
+            cursor.execute(f"""
+                UPDATE {REGISTRY_TABLE_NAME}
+                SET status = 'active', retired_at = NULL
+                WHERE name = %s
+            """, (version,))
+        return row[0], row[1], row[2]
+
+    def activate(self, version: str) -> None:
+        """
+        Atomically make a ready or retired version the active one.
+        The previously active version is retired and kept for rollback.
+
+        :param version: The name of the version to activate.
+        :raises ValueError: If the version cannot be activated.
+        """
+        with self.ingest_lock:
+            db_connection = get_db_connection()
+            try:
+                chunk_size, chunk_overlap, embedding_model = self._switch(db_connection, version)
+                db_connection.commit()
+            finally:
+                db_connection.close()
+
+            self._active = self._load_version(version, embedding_model, (chunk_size, chunk_overlap))
+            print(f"Switched active collection version to {version}.")
+
+    def add_document(self, local_file_path: str, source: str) -> str:
+        """
+        Split and embed a PDF into the active version, using that version's
+        chunking parameters and embedding model.
+
+        The active row of the registry is locked while the document is written,
+        so no process can switch versions halfway through.
+
+        :param local_file_path: Path of the PDF on local disk.
+        :param source: The S3 key of the PDF, recorded as the chunks' source.
+        :return: The name of the version the document was added to.
+        """
+        with self.ingest_lock:
+            db_connection = get_db_connection()
+            try:
+                with db_connection.cursor() as cursor:
+                    cursor.execute(f"""
+                        SELECT name, chunk_size, chunk_overlap, embedding_model FROM {REGISTRY_TABLE_NAME}
+                        WHERE status = 'active'
+                        FOR SHARE
+                    """)
+                    row = cursor.fetchone()
+                if row is None:
+                    raise ValueError(f"No active collection version found in {REGISTRY_TABLE_NAME}.")
+                version, chunk_size, chunk_overlap, embedding_model = row
+
+                documents = load_documents_from_pdfs([local_file_path])
+                chunks = split_documents(documents, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+                for chunk in chunks:
+                    chunk['metadata']['source'] = source
+
+                # Commits, and thereby releases the lock on the active row
+                update_vector_store(chunks, version, db_connection, embedding_model)
+                db_connection.commit()
+            finally:
+                db_connection.close()
+
+            # Another process may have switched versions since the last refresh
+            if version != self.active_version:
+                self._active = self._load_version(version, embedding_model, (chunk_size, chunk_overlap))
+
+        return version
+
+    def refresh_active_version(self) -> None:
+        """
+        Pick up a switch of the active version made by another process.
+        """
+        db_connection = get_db_connection()
+        try:
+            version, chunk_size, chunk_overlap, embedding_model = self._get_active_version(db_connection)
+        finally:
+            db_connection.close()
+
+        if version != self.active_version:
+            with self.ingest_lock:
+                self._active = self._load_version(version, embedding_model, (chunk_size, chunk_overlap))
+            print(f"Picked up active collection version {version}.")
+
+    def garbage_collect(self) -> List[str]:
+        """
+        Delete failed, abandoned and expired retired versions.
+        The most recently retired versions are always kept for rollback.
+
+        :return: The names of the deleted versions.
+        """
+        db_connection = get_db_connection()
+        try:
+            self._fail_stale_builds(db_connection)
+            with db_connection.cursor() as cursor:
+                cursor.execute(f"""
+                    SELECT name, embedding_model, status, created_at, retired_at
+                    FROM {REGISTRY_TABLE_NAME}
+                    WHERE status IN ('retired', 'failed')
+                    ORDER BY retired_at DESC NULLS LAST
+                """)
+                rows = cursor.fetchall()
+        finally:
+            db_connection.close()
+
+        cutoff = datetime.now(timezone.utc) - self.retention
+        retired_seen = 0
+        expired = []
+        for name, embedding_model, status, created_at, retired_at in rows:
+            if status == 'retired':
+                retired_seen += 1
+                if retired_seen > self.rollback_versions and retired_at < cutoff:
+                    expired.append((name, embedding_model))
+            else:
+                expired.append((name, embedding_model))
+
+        deleted = []
+        for name, embedding_model in expired:
+            try:
+                db_connection = get_db_connection()
+                try:
+                    with db_connection.cursor() as cursor:
+                        # Claim the version first, it may have been rolled back to in the meantime.
+                        # The row stays locked, so activate waits until the collection is gone.
+                        cursor.execute(f"""
+                            DELETE FROM {REGISTRY_TABLE_NAME}
+                            WHERE name = %s AND status IN ('retired', 'failed')
+                            RETURNING name
+                        """, (name,))
+                        claimed = cursor.fetchone() is not None
+                    if not claimed:
+                        db_connection.rollback()
+                        continue
+
+                    vector_store = self._load_version(name, embedding_model)[3]
+                    vector_store.delete_collection()
+                    db_connection.commit()
+                finally:
+                    db_connection.close()
+
+                deleted.append(name)
+                print(f"Garbage-collected collection version {name}.")
+            except Exception as e:
+                print(f"Error garbage-collecting collection version {name}: {e}")
+
+        return deleted
+
+    def start_scheduler(self, poll_interval: float = 30, gc_interval: float = 3600) -> None:
+        """
+        Start a background thread that follows active version switches made by
+        other processes and periodically garbage-collects old versions.
+
+        :param poll_interval: Seconds between checks of the active version.
+        :param gc_interval: Seconds between garbage collection runs.
+        """
+        if self._scheduler_thread is not None:
+            return
+
+        def run():
+            next_gc = 0.0
+            elapsed = 0.0
+            while not self._scheduler_stop.wait(poll_interval):
+                elapsed += poll_interval
+                try:
+                    self.refresh_active_version()
+                    if elapsed >= next_gc:
+                        self.garbage_collect()
+                        next_gc = elapsed + gc_interval
+                except Exception as e:
+                    print(f"Error in collection version scheduler: {e}")
+
+        self._scheduler_stop.clear()
+        self._scheduler_thread = threading.Thread(target=run, name="collection-versions", daemon=True)
+        self._scheduler_thread.start()
+
+    def stop_scheduler(self) -> None:
+        """
+        Stop the background scheduler thread, if running.
+        """
+        if self._scheduler_thread is None:
+            return
+        self._scheduler_stop.set()
+        self._scheduler_thread.join()
+        self._scheduler_thread = None
+
+
+class VersionedRetriever(BaseRetriever):
+    """
+    Retriever that always searches the currently active collection version,
+    so version switches take effect without rebuilding the chains using it.
+    """
+    manager: Any
+    search_kwargs: dict = Field(default_factory=dict)
+
+    def _get_relevant_documents(self,
+                                query: str,
+                                *,
+                                run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.manager.vector_store.similarity_search(query, **self.search_kwargs)
@@ -5,6 +5,23 @@ from langchain_postgres import PostgresChatMessageHistory
 from langchain_core.messages import BaseMessage, message_to_dict
 import psycopg
 
+
+def strip_null_bytes(value):
+    """
+    Replace null bytes in all strings of a serializable value, since JSONB rejects them.
+
+    :param value: A string, list or dict, possibly nested.
+    :return: The value with null bytes replaced by spaces.
+    """
+    if isinstance(value, str):
+        return value.replace("\0", " ")
+    if isinstance(value, list):
+        return [strip_null_bytes(item) for item in value]
+    if isinstance(value, dict):
+        return {key: strip_null_bytes(item) for key, item in value.items()}
+    return value
+
+
 class CustomChatMessageHistory(PostgresChatMessageHistory):
     @classmethod
     def create_custom_table(cls, connection, table_name):
@@ -38,16 +55,31 @@ class CustomChatMessageHistory(PostgresChatMessageHistory):
             )
 
         values = [
-            (self._session_id, self.session_name, json.dumps(message_to_dict(message)))
+            (self._session_id, self.session_name, message)
             for message in messages
         ]
 
+        self.insert_messages(self._connection, self.table_name, values)
 
+    @classmethod
+    def insert_messages(cls, connection, table_name, values):
+        """
+        Insert messages of one or more sessions in a single transaction.
+
+        :param connection: A psycopg connection object.
+        :param table_name: The name of the chat history table.
+        :param values: A sequence of (session_id, session_name, message) tuples.
+        """
         query = f"""
-            INSERT INTO {self.table_name} (session_id, session_name, message)
+            INSERT INTO {table_name} (session_id, session_name, message)
             VALUES (%s, %s, %s)
         """
 
-        with self._connection.cursor() as cursor:
-            cursor.executemany(query, values)
-        self._connection.commit()
\ No newline at end of file
+        rows = [
+            (str(session_id), session_name, json.dumps(strip_null_bytes(message_to_dict(message))))
+            for session_id, session_name, message in values
+        ]
+
+        with connection.cursor() as cursor:
+            cursor.executemany(query, rows)
+        connection.commit()
\ No newline at end of file
@@ -0,0 +1,379 @@
+import atexit
+import threading
+import uuid
+import weakref
+from collections import OrderedDict
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage
+import psycopg
+
+from CustomMessageHistory import CustomChatMessageHistory
+
+
+class _SessionToken:
+    """
+    Shared by all history objects of a session until the session is deleted.
+    """
+
+    def __init__(self):
+        self.cleared = False
+
+
+class CachedChatMessageHistory(BaseChatMessageHistory):
+    """
+    Chat history of a single session kept in memory by a SessionHistoryCache.
+
+    Reads are served from memory. New messages are appended in memory right away
+    and handed to the cache to be persisted in the background.
+    """
+
+    def __init__(self,
+                 cache: "SessionHistoryCache",
+                 session_id: str,
+                 session_name: str,
+                 messages: List[BaseMessage]):
+        self._cache = cache
+        self.session_id = session_id
+        self.session_name = session_name
+        self._messages = messages
+        # Checked on every append, so turns still in flight when the session is deleted are dropped
+        self._token = cache._get_token(session_id)
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        with self._cache.lock:
+            return list(self._messages)
+
+    def get_messages(self) -> List[BaseMessage]:
+        """Retrieve messages from the chat message history."""
+        return self.messages
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """Add messages to the chat message history."""
+        with self._cache.lock:
+            if self._token.cleared:
+                return
+
+            # The session may have been evicted and reloaded while this turn was running
+            current = self._cache._sessions.get(self.session_id)
+            if current is not None and current is not self:
+                current._messages.extend(messages)
+            self._messages.extend(messages)
+            queued = self._cache._try_enqueue(self.session_id, self.session_name, messages)
+
+        if not queued:
+            self._cache._write_directly(self.session_id, self.session_name, messages)
+
+    def clear(self) -> None:
+        """Clear the chat message history."""
+        self._cache.clear(self.session_id)
+
+
+class SessionHistoryCache:
+    """
+    Bounded LRU cache of recent session histories with write-behind persistence.
+
+    Appended messages are queued and written to Postgres in batches by a background
+    thread. Sessions loaded from the database always include messages that are still
+    queued, so reads stay consistent with writes. close() flushes everything left
+    in the queue and is also run at interpreter exit.
+    """
+
+    def __init__(self,
+                 table_name: str,
+                 connection_factory: Callable[[], psycopg.Connection],
+                 max_sessions: int = 256,
+                 batch_size: int = 100,
+                 flush_interval: float = 1.0,
+                 max_batch_retries: int = 3):
+        """
+        :param table_name: The name of the chat history table.
+        :param connection_factory: Callable returning a new psycopg connection.
+        :param max_sessions: Maximum number of session histories kept in memory.
+        :param batch_size: Number of queued messages that triggers an immediate flush.
+        :param flush_interval: Maximum number of seconds a message stays queued.
+        :param max_batch_retries: Number of failed batch writes before messages are written one at a time.
+        """
+        self.table_name = table_name
+        self.connection_factory = connection_factory
+        self.max_sessions = max_sessions
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_batch_retries = max_batch_retries
+
+        # Guards the cached histories, the queue and the load bookkeeping
+        self.lock = threading.RLock()
+        # Notified when a batch is no longer being written
+        self._flushed = threading.Condition(self.lock)
+        # Serializes batch writes and deletes, so a deleted session is never written back
+        self._flush_lock = threading.Lock()
+        self._sessions: "OrderedDict[str, CachedChatMessageHistory]" = OrderedDict()
+        self._queue: List[Tuple[str, str, BaseMessage]] = []
+        self._failed_attempts = 0
+        self._connection = None
+        # Token of every session that still has a live history object
+        self._tokens: "weakref.WeakValueDictionary[str, _SessionToken]" = weakref.WeakValueDictionary()
+
+        # Sessions in the batch currently being written
+        self._inflight_sessions = set()
+        # Sessions being loaded from the database, each with one flag per load that is
+        # set when the session is written or deleted while the load is running
+        self._loading: Dict[str, List[List[bool]]] = {}
+
+        self._wakeup = threading.Event()
+        self._closed = threading.Event()
+        self._writer = threading.Thread(target=self._run, name="chat-history-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def get(self, session_id: str, session_name: str = None) -> CachedChatMessageHistory:
+        """
+        Retrieve the chat history for a session, loading it from the database on a miss.
+
+        :param session_id: The UUID of the session.
+        :param session_name: An optional name for the session.
+        :return: A CachedChatMessageHistory object for the session.
+        """
+        session_id = self._normalize(session_id)
+
+        while True:
+            with self._flushed:
+                history = self._sessions.get(session_id)
+                if history is not None:
+                    self._sessions.move_to_end(session_id)
+                    if history.session_name is None:
+                        history.session_name = session_name
+                    return history
+
+                # Rows of a batch being written may or may not be visible yet
+                while session_id in self._inflight_sessions:
+                    self._flushed.wait()
+                stale = [False]
+                self._loading.setdefault(session_id, []).append(stale)
+
+            try:
+                stored = self._read_messages(session_id, session_name)
+            except Exception:
+                with self.lock:
+                    self._finish_loading(session_id, stale)
+                raise
+
+            with self.lock:
+                self._finish_loading(session_id, stale)
+                if stale[0]:
+                    # A write or delete raced with the read, so read again
+                    continue
+
+                # Another request may have loaded the session in the meantime
+                history = self._sessions.get(session_id)
+                if history is None:
+                    queued = [message for queued_id, _, message in self._queue if queued_id == session_id]
+                    history = CachedChatMessageHistory(self, session_id, session_name, stored + queued)
+                    self._sessions[session_id] = history
+                    while len(self._sessions) > self.max_sessions:
+                        self._sessions.popitem(last=False)
+                else:
+                    self._sessions.move_to_end(session_id)
+                return history
+
+    def _read_messages(self, session_id: str, session_name: str) -> List[BaseMessage]:
+        connection = self.connection_factory()
+        try:
+            return CustomChatMessageHistory(
+                self.table_name,
+                session_id,
+                session_name,
+                sync_connection=connection).get_messages()
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _normalize(session_id) -> str:
+        # The column is a UUID, so differently formatted IDs refer to the same rows
+        return str(uuid.UUID(str(session_id)))
+
+    def _get_token(self, session_id: str) -> _SessionToken:
+        with self.lock:
+            token = self._tokens.get(session_id)
+            if token is None:
+                token = _SessionToken()
+                self._tokens[session_id] = token
+            return token
+
+    def _finish_loading(self, session_id: str, stale: List[bool]) -> None:
+        loads = self._loading[session_id]
+        loads.remove(stale)
+        if not loads:
+            del self._loading[session_id]
+
+    def _mark_stale(self, session_ids) -> None:
+        for session_id in session_ids:
+            for stale in self._loading.get(session_id, []):
+                stale[0] = True
+
+    def enqueue(self, session_id: str, session_name: str, messages: Sequence[BaseMessage]) -> None:
+        """
+        Queue messages to be written to the database.
+
+        :param session_id: The UUID of the session.
+        :param session_name: The name of the session.
+        :param messages: The messages to write.
+        """
+        if not self._try_enqueue(session_id, session_name, messages):
+            self._write_directly(session_id, session_name, messages)
+
+    def _try_enqueue(self, session_id: str, session_name: str, messages: Sequence[BaseMessage]) -> bool:
+        """
+        Queue messages unless the cache has been closed.
+
+        :return: Whether the messages were queued.
+        """
+        with self.lock:
+            if self._closed.is_set():
+                return False
+            self._queue.extend((session_id, session_name, message) for message in messages)
+            if len(self._queue) >= self.batch_size:
+                self._wakeup.set()
+            return True
+
+    def _write_directly(self, session_id: str, session_name: str, messages: Sequence[BaseMessage]) -> None:
+        # The writer is gone, so persist right away. Called without holding the lock.
+        connection = self.connection_factory()
+        try:
+            CustomChatMessageHistory.insert_messages(
+                connection,
+                self.table_name,
+                [(session_id, session_name, message) for message in messages])
+        finally:
+            connection.close()
+
+    def clear(self, session_id: str) -> None:
+        """
+        Delete all messages of a session, including queued ones.
+
+        :param session_id: The UUID of the session.
+        """
+        session_id = self._normalize(session_id)
+
+        with self._flush_lock:
+            with self.lock:
+                self._queue = [entry for entry in self._queue if entry[0] != session_id]
+                self._sessions.pop(session_id, None)
+                token = self._tokens.pop(session_id, None)
+                if token is not None:
+                    token.cleared = True
+                self._mark_stale([session_id])
+
+            connection = self.connection_factory()
+            try:
+                CustomChatMessageHistory(
+                    self.table_name,
+                    session_id,
+                    None,
+                    sync_connection=connection).clear()
+            finally:
+                connection.close()
+
+    def flush(self) -> None:
+        """
+        Write all queued messages to the database in a single transaction.
+
+        On failure the messages are put back at the front of the queue. After
+        max_batch_retries failures they are written one at a time instead, and
+        messages that still fail are logged and dropped.
+        """
+        with self._flush_lock:
+            with self.lock:
+                batch, self._queue = self._queue, []
+                if not batch:
+                    return
+                self._inflight_sessions = {session_id for session_id, _, _ in batch}
+                self._mark_stale(self._inflight_sessions)
+
+            try:
+                if self._failed_attempts < self.max_batch_retries:
+                    self._write_batch(batch)
+                else:
+                    self._write_rows(batch)
+                self._failed_attempts = 0
+            except Exception:
+                self._failed_attempts += 1
+                with self.lock:
+                    self._queue = batch + self._queue
+                raise
+            finally:
+                with self._flushed:
+                    self._inflight_sessions = set()
+                    self._flushed.notify_all()
+
+    def _get_connection(self) -> psycopg.Connection:
+        if self._connection is None or self._connection.closed:
+            self._connection = self.connection_factory()
+        return self._connection
+
+    def _reset_connection(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _write_batch(self, batch: List[Tuple[str, str, BaseMessage]]) -> None:
+        try:
+            CustomChatMessageHistory.insert_messages(self._get_connection(), self.table_name, batch)
+        except Exception:
+            self._reset_connection()
+            raise
+
+    def _write_rows(self, batch: List[Tuple[str, str, BaseMessage]]) -> None:
+        """
+        Write messages one at a time so a single bad message cannot block the rest.
+        """
+        for index, entry in enumerate(batch):
+            try:
+                CustomChatMessageHistory.insert_messages(self._get_connection(), self.table_name, [entry])
+            except psycopg.OperationalError:
+                # The database is unreachable rather than the message being bad, so keep the rest
+                self._reset_connection()
+                with self.lock:
+                    self._queue = batch[index:] + self._queue
+                return
+            except Exception as e:
+                self._reset_connection()
+                print(f"Dropping chat history message for session {entry[0]}: {e}")
+
+    def _run(self):
+        while not self._closed.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error writing chat history: {e}")
+
+    def close(self, retries: int = 3) -> None:
+        """
+        Stop the background writer and flush every queued message.
+
+        :param retries: Number of attempts at the final flush.
+        """
+        with self.lock:
+            if self._closed.is_set():
+                return
+            # Set under the lock so every enqueue either lands before the final flush or is written directly
+            self._closed.set()
+        self._wakeup.set()
+        self._writer.join()
+
+        try:
+            for attempt in range(1, retries + 1):
+                try:
+                    self.flush()
+                    if not self._queue:
+                        break
+                except Exception as e:
+                    print(f"Error writing chat history on shutdown (attempt {attempt}/{retries}): {e}")
+            else:
+                print(f"Lost {len(self._queue)} chat history messages on shutdown.")
+        finally:
+            self._reset_connection()
@@ -1,20 +1,18 @@
 import os
-from typing import Any, Generator, List
+from typing import Generator, List
 import uuid
 from fastapi import HTTPException
 from langchain_openai import OpenAIEmbeddings
 from langchain_postgres import PGVector, PostgresChatMessageHistory
 from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_core.documents.base import Document
-from langchain_core.runnables.base import Runnable
 from langchain.chains import create_retrieval_chain
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.document_loaders import PyPDFLoader
 import psycopg
 import boto3
 
-from CustomMessageHistory import CustomChatMessageHistory
 from CustomRunnableWithMessageHistory import CustomRunnableWithMessageHistory
+from SessionHistoryCache import CachedChatMessageHistory, SessionHistoryCache
 
 # Initalize S3 client
 s3 = boto3.client('s3')
@@ -42,23 +40,23 @@ def get_db_connection():
     return psycopg.connect(DATABASE_URL, sslmode='require')
 
 
-def get_chat_history(session_id: str, session_name: str = None) -> CustomChatMessageHistory:
+# Keep recent session histories in memory and write new messages in the background
+history_cache = SessionHistoryCache(TABLE_NAME,
+                                    get_db_connection,
+                                    max_sessions=int(os.environ.get("HISTORY_CACHE_SIZE", 256)),
+                                    batch_size=int(os.environ.get("HISTORY_BATCH_SIZE", 100)),
+                                    flush_interval=float(os.environ.get("HISTORY_FLUSH_INTERVAL", 1.0)))
+
+
+def get_chat_history(session_id: str, session_name: str = None) -> CachedChatMessageHistory:
     """
     Retrieve chat history for a given session.
 
     :param session_id: The UUID or string identifier of the session.
     :param session_name: An optional name for the session.
-    :return: A CustomChatMessageHistory object containing the chat history.
+    :return: A CachedChatMessageHistory object containing the chat history.
     """
-    connection = get_db_connection()
-
-    history = CustomChatMessageHistory(
-        TABLE_NAME, 
-        str(session_id), 
-        session_name, 
-        sync_connection=connection)
-
-    return history
+    return history_cache.get(session_id, session_name)
 
 
 def delete_chat_history(session_id: str, session_name: str = None) -> None:
@@ -68,19 +66,11 @@ def delete_chat_history(session_id: str, session_name: str = None) -> None:
     :param session_id: The UUID or string identifier of the session.
     :param session_name: An optional name for the session.
     """
-    connection = get_db_connection()
     try:
-        history = CustomChatMessageHistory(
-            TABLE_NAME, 
-            session_id, 
-            session_name, 
-            sync_connection=connection)
-        # Delete all messages associated with this session
-        history.clear()
+        # Delete all messages associated with this session, including ones not yet written
+        history_cache.clear(session_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred while deleting the session: {e}")
-    finally:
-        connection.close()
 
 
 def get_vector_store(embeddings_model: OpenAIEmbeddings,
@@ -126,21 +116,17 @@ def get_runnanble_chain(history_aware_retriever, question_answer_chain) -> Custo
 # Streaming response generator
 def stream_rag_response(user_input: str, 
                         session_name: str, 
-                        history_aware_retriever: Runnable[Any, List[Document]], 
-                        question_answer_chain: Runnable) -> Generator[str, None, None]:
+                        conversational_rag_chain: CustomRunnableWithMessageHistory) -> Generator[str, None, None]:
     """
     Stream responses from the RAG model based on user input and chat history.
 
     :param user_input: The user's input or query.
     :param session_anme: The human_readable name to retrieve chat history for context.
-    :param history_aware_retriever: A runnable object for retrieving relevant documents.
-    :param question_answer_chain: A runnable object for generating responses.
+    :param conversational_rag_chain: The RAG chain wrapped with history tracking, see get_runnanble_chain.
     :yield: Chunks of text as they are generated by the RAG model.
     """
     try:
         # Stream the response from the model
-        conversational_rag_chain = get_runnanble_chain(history_aware_retriever, question_answer_chain)
-
         response_stream = conversational_rag_chain.stream({"input": user_input},
                                            config={"configurable": {
                                                "session_id": uuid.uuid5(uuid.NAMESPACE_DNS, session_name),
@@ -166,6 +152,17 @@ def clean_chunk(text: str) -> str:
     return text.replace("\0", " ")
 
 
+def source_name(source: str) -> str:
+    """
+    Normalize a document source to its file name, so sources recorded as
+    Windows paths, POSIX paths or S3 keys can be compared.
+
+    :param source: The 'source' metadata of a chunk.
+    :return: The file name of the source.
+    """
+    return source.replace("\\", "/").rsplit("/", 1)[-1]
+
+
 def get_existing_sources(connection, collection_name: str) -> List[str]:
     """
     Retrieve existing document sources from the vector store.
@@ -180,16 +177,17 @@ def get_existing_sources(connection, collection_name: str) -> List[str]:
     return existing_sources
 
 
-def update_vector_store(chunks, collection_name, connection):
+def update_vector_store(chunks, collection_name, connection, embedding_model: str = "text-embedding-3-small"):
     """
     Create a PGVector vector store from text chunks and save it.
 
     :param chunks: List of text chunks with metadata.
-    :param save_path: Path to save the FAISS vector store.
+    :param collection_name: The name of the collection in the vector store.
     :param connection: The PGVector connection object.
+    :param embedding_model: The OpenAI embedding model used by the collection.
     """
     # Initialize the OpenAI embeddings model
-    embeddings_model = OpenAIEmbeddings(api_key=OPENAI_API_KEY, model="text-embedding-3-small")
+    embeddings_model = OpenAIEmbeddings(api_key=OPENAI_API_KEY, model=embedding_model)
 
     # Extract texts and metadata
     texts = [chunk['text'] for chunk in chunks]
@@ -197,13 +195,13 @@ def update_vector_store(chunks, collection_name, connection):
     metadata = [chunk['metadata'] for chunk in chunks]
 
     # Retrieve existing sources
-    existing_sources = get_existing_sources(connection, collection_name)
+    existing_sources = {source_name(source) for source in get_existing_sources(connection, collection_name)}
 
     # Filter out chunks that already exist in the vector store
     new_texts = []
     new_metadata = []
     for text, meta in zip(clean_texts, metadata):
-        if meta['source'] not in existing_sources:
+        if source_name(meta['source']) not in existing_sources:
             new_texts.append(text)
             new_metadata.append(meta)
 
@@ -254,14 +252,16 @@ def load_documents_from_pdfs(pdf_files):
     return documents
 
 
-def split_documents(documents):
+def split_documents(documents, chunk_size: int = 500, chunk_overlap: int = 100):
     """
     Split loaded documents into smaller chunks for vectorization.
 
     :param documents: List of documents with their pages.
+    :param chunk_size: Maximum number of characters per chunk.
+    :param chunk_overlap: Number of characters shared by consecutive chunks.
     :return: List of text chunks with metadata.
     """
-    splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
     all_chunks = []
 
     for doc in documents:
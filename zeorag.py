@@ -1,11 +1,12 @@
 import os
 import logging
+import tempfile
 import uuid
 
-from fastapi import FastAPI, File, HTTPException, UploadFile
+from fastapi import BackgroundTasks, FastAPI, File, HTTPException, UploadFile
 from pydantic import BaseModel
 from fastapi.responses import StreamingResponse
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_openai import ChatOpenAI
 from langchain.chains import create_history_aware_retriever
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain.prompts.chat import ChatPromptTemplate
@@ -16,9 +17,10 @@ import boto3
 import psycopg
 import uvicorn
 
-from helpers import get_chat_history, delete_chat_history, stream_rag_response, get_vector_store
-from helpers import get_db_connection, load_documents_from_pdfs, split_documents, update_vector_store
-from helpers import is_valid_uuid
+from helpers import get_chat_history, delete_chat_history, stream_rag_response, get_runnanble_chain
+from helpers import source_name
+from helpers import is_valid_uuid, history_cache
+from CollectionVersionManager import CollectionVersionManager, VersionedRetriever
 # from CustomMessageHistory import CustomChatMessageHistory
 
 # Suppress lower-severity messages
@@ -62,6 +64,13 @@ class QueryRequest(BaseModel):
     question: str
     session_name: str
 
+# Define the collection build request model
+class CollectionBuildRequest(BaseModel):
+    chunk_size: int = 500
+    chunk_overlap: int = 100
+    embedding_model: str = "text-embedding-3-small"
+    activate: bool = True
+
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 
 COLLECTION_NAME = 'papers'
@@ -73,11 +82,14 @@ if connection.startswith("postgres://"):
 
 # Leave temeprature at 0 for easier empirical evaluation
 llm = ChatOpenAI(model="gpt-4o-2024-05-13", temperature=0, api_key=OPENAI_API_KEY)
-embeddings_model = OpenAIEmbeddings(api_key=OPENAI_API_KEY, model="text-embedding-3-small")
 
-vector_store = get_vector_store(embeddings_model,
-                                COLLECTION_NAME,
-                                connection)
+# Queries are served from the active version of the collection, which can be
+# rebuilt in the background and switched to without downtime
+version_manager = CollectionVersionManager(COLLECTION_NAME,
+                                           connection,
+                                           s3,
+                                           S3_BUCKET_NAME,
+                                           api_key=OPENAI_API_KEY)
 
 contextualize_q_system_prompt = (
     "Given a chat history and the latest user question "
@@ -96,7 +108,7 @@ contextualize_q_prompt = ChatPromptTemplate.from_messages(
 )
 
 history_aware_retriever = create_history_aware_retriever(
-    llm, vector_store.as_retriever(), contextualize_q_prompt
+    llm, VersionedRetriever(manager=version_manager), contextualize_q_prompt
 )
 
 # Add custom system prompt
@@ -117,6 +129,35 @@ prompt = ChatPromptTemplate.from_messages(
 
 question_answer_chain = create_stuff_documents_chain(llm, prompt)
 
+# Build the chain once and reuse it across requests
+conversational_rag_chain = get_runnanble_chain(history_aware_retriever, question_answer_chain)
+
+
+@app.on_event("startup")
+def start_collection_scheduler():
+    """
+    Start following active collection switches and garbage-collecting old versions.
+    """
+    version_manager.start_scheduler(
+        poll_interval=float(os.environ.get("COLLECTION_POLL_INTERVAL", 30)),
+        gc_interval=float(os.environ.get("COLLECTION_GC_INTERVAL", 3600)))
+
+
+@app.on_event("shutdown")
+def stop_collection_scheduler():
+    """
+    Stop the collection version scheduler.
+    """
+    version_manager.stop_scheduler()
+
+
+@app.on_event("shutdown")
+def flush_chat_history():
+    """
+    Write all chat history messages that are still queued to the database.
+    """
+    history_cache.close()
+
 @app.get("/sessions/{session_id}")
 def get_history(session_id: str):
     """
@@ -179,6 +220,8 @@ def get_sessions_with_messages():
         HTTPException: If an error occurs during retrieval.
     """
     try:
+        # Make sure messages still queued for writing are included
+        history_cache.flush()
         connection = psycopg.connect(connection_string, sslmode='require')
         with connection.cursor() as cursor:
             cursor.execute(f"""
@@ -211,14 +254,13 @@ async def query_rag(request: QueryRequest):
         # Use StreamingResponse to stream the RAG model's response
         return StreamingResponse(stream_rag_response(request.question, 
                                                      request.session_name,
-                                                     history_aware_retriever,
-                                                     question_answer_chain), media_type="text/plain")
+                                                     conversational_rag_chain), media_type="text/plain")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {e}")
 
 
 @app.post("/upload_document/")
-async def upload_document(file: UploadFile = File(...)):
+def upload_document(file: UploadFile = File(...)):
     """
     Upload a PDF document, process it, and add it to the vector store.
 
@@ -232,30 +274,27 @@ async def upload_document(file: UploadFile = File(...)):
         HTTPException: If an error occurs during the upload or processing.
     """
     try:
-        # Read the file first to avoid the upload process closing it
-        file_content = await file.read()
+        # Read the file first to avoid the upload process closing it.
+        # The handler is sync so the blocking work below runs in the threadpool.
+        file_content = file.file.read()
 
         print(f"Uploading {file.filename}...")
         s3.upload_fileobj(file.file, S3_BUCKET_NAME, file.filename)
         print(f"Uploaded {file.filename} to {S3_BUCKET_NAME}.")
         
         # Save the file locally for processing
-        local_file_path = f"C:/TUE/Thesis/RAG/papers/{file.filename}"
-        with open(local_file_path, 'wb') as f:
-            print(f"Writing {file.filename} to {local_file_path}...")
-            f.write(file_content)
-            print(f"Wrote {file.filename} to {local_file_path}.")
-
-        print(f"Loading {local_file_path}...")
-        documents = load_documents_from_pdfs([local_file_path])
-        chunks = split_documents(documents)
-
-        connection = get_db_connection()
-
-        update_vector_store(chunks, COLLECTION_NAME, connection)
-
-        # Clean up the local file
-        os.remove(local_file_path)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            local_file_path = os.path.join(tmp_dir, source_name(file.filename))
+            with open(local_file_path, 'wb') as f:
+                print(f"Writing {file.filename} to {local_file_path}...")
+                f.write(file_content)
+                print(f"Wrote {file.filename} to {local_file_path}.")
+
+            # Chunked and embedded with the settings of the active version, which
+            # cannot be switched by any worker until the document is stored
+            print(f"Loading {local_file_path}...")
+            version = version_manager.add_document(local_file_path, file.filename)
+            print(f"Added {file.filename} to collection version {version}.")
 
         return {"message": "Document uploaded and processed successfully."}
 
@@ -290,5 +329,73 @@ def list_documents():
         raise HTTPException(status_code=500, detail=f"An error occurred: {e}")
 
 
+@app.get("/collections")
+def list_collections():
+    """
+    Retrieve all versions of the document collection.
+
+    Returns:
+        dict: The active version and a list of all versions with their build parameters and status.
+
+    Raises:
+        HTTPException: If an error occurs during retrieval.
+    """
+    try:
+        return {"active": version_manager.active_version,
+                "versions": version_manager.list_versions()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {e}")
+
+
+@app.post("/collections")
+def build_collection(request: CollectionBuildRequest, background_tasks: BackgroundTasks):
+    """
+    Start building a new version of the document collection in the background.
+
+    Args:
+        request (CollectionBuildRequest): The chunking and embedding parameters for the new version.
+
+    Returns:
+        dict: The name of the version being built.
+
+    Raises:
+        HTTPException: If another version is already being built or an error occurs.
+    """
+    try:
+        version = version_manager.create_version(request.chunk_size,
+                                                 request.chunk_overlap,
+                                                 request.embedding_model)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {e}")
+
+    background_tasks.add_task(version_manager.build_version, version, request.activate)
+    return {"message": f"Building collection version {version}.", "version": version}
+
+
+@app.post("/collections/{version}/activate")
+def activate_collection(version: str):
+    """
+    Switch queries to a given collection version, e.g. to roll back.
+
+    Args:
+        version (str): The name of the collection version.
+
+    Returns:
+        dict: A message indicating the result of the switch.
+
+    Raises:
+        HTTPException: If the version cannot be activated.
+    """
+    try:
+        version_manager.activate(version)
+        return {"message": f"Collection version {version} is now active."}
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {e}")
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file